@@ -0,0 +1,47 @@
+"""
+Helpers shared by the benchmarks.
+"""
+import os
+import subprocess
+import sys
+import types
+from timeit import default_timer
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, root)
+
+
+def load_revision(revision, name='pyschema_reference'):
+    """
+    Import pyschema.py as it is at a git revision, to compare against the working tree
+
+    :param revision: Git revision, the root commit (the original code) if None
+    :return: Module
+    """
+    if revision is None:
+        revision = subprocess.check_output(['git', 'rev-list', '--max-parents=0', 'HEAD'], cwd=root).split()[-1].decode('ascii')
+    source = subprocess.check_output(['git', 'show', '%s:pyschema.py' % revision], cwd=root)
+    module = types.ModuleType(name)
+    module.__file__ = os.path.join(root, 'pyschema.py')
+    exec(compile(source, '%s:pyschema.py' % revision, 'exec'), module.__dict__)
+    module.revision = revision
+    return module
+
+
+def interleaved(functions, number, rounds=30):
+    """
+    Time functions in alternation, so that changes in machine load affect all of them alike
+
+    :param functions: Functions to time
+    :param number: Calls per function in each round
+    :param rounds: Number of rounds
+    :return: Median seconds per call of each function
+    """
+    samples = [[] for _ in functions]
+    for _ in range(rounds):
+        for function, times in zip(functions, samples):
+            start = default_timer()
+            for _ in range(number):
+                function()
+            times.append((default_timer() - start) / number)
+    return [sorted(times)[len(times) // 2] for times in samples]
@@ -0,0 +1,79 @@
+"""
+Track the cost of importing pyschema, for short lived CLI validators and workers.
+
+Run from the repository root:
+    python benchmarks/import_time.py
+
+Reports the cumulative import time of pyschema from `python -X importtime` (PY3.7+) with the
+slowest modules it imports, and the wall time of starting python to validate a document.
+"""
+import os
+import subprocess
+import sys
+import timeit
+
+from six import print_ as print_out
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+validate_code = (
+    "import pyschema; "
+    "pyschema.Schema({'type': 'map', 'display_name': 'Root', 'allow_unknown_children': True, "
+    "'value_schema': {'type': 'number', 'display_name': 'Value'}}).validate({'a': 1})"
+)
+
+
+def run_python(args):
+    env = dict(os.environ)
+    # Measure with compiled bytecode, as installed code would run
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    env['PYTHONPATH'] = root
+    return subprocess.Popen([sys.executable] + args, env=env, cwd=root,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()
+
+
+def import_times():
+    """
+    :return: List of (cumulative microseconds, module name) for pyschema, followed by the
+        modules imported while importing it
+    """
+    _, err = run_python(['-X', 'importtime', '-c', 'import pyschema'])
+    modules = []
+    for line in err.decode('utf-8').splitlines():
+        if not line.startswith('import time:'):
+            continue
+        parts = line[len('import time:'):].split('|')
+        if not parts[1].strip().isdigit():
+            # Header line
+            continue
+        # Names are indented by nesting level, after a single space
+        modules.append((int(parts[1]), parts[2][1:]))
+
+    names = [x[1] for x in modules]
+    if 'pyschema' not in names:
+        return []
+    # Modules imported by pyschema are reported just before it, indented
+    position = names.index('pyschema')
+    nested = []
+    for cumulative_us, name in reversed(modules[:position]):
+        if not name.startswith(' '):
+            break
+        nested.append((cumulative_us, name.strip()))
+    return [modules[position]] + nested
+
+
+if __name__ == '__main__':
+    run_python(['-c', 'import pyschema'])
+
+    if sys.version_info >= (3, 7):
+        times = import_times()
+        if times:
+            print_out('import pyschema: %.2f ms cumulative' % (times[0][0] / 1000.0))
+            for cumulative_us, name in sorted(times[1:], reverse=True)[:10]:
+                print_out('    %8.2f ms  %s' % (cumulative_us / 1000.0, name))
+
+    number = 20
+    startup = min(timeit.repeat(lambda: run_python(['-c', 'pass']), number=number, repeat=3)) / number
+    validate = min(timeit.repeat(lambda: run_python(['-c', validate_code]), number=number, repeat=3)) / number
+    print_out('python startup:                 %.2f ms' % (startup * 1000))
+    print_out('startup + import and validate:  %.2f ms (+%.2f ms)' % (validate * 1000, (validate - startup) * 1000))
@@ -0,0 +1,44 @@
+"""
+Measure the cost of recording metrics on the validate() hot path.
+
+Run from the repository root:
+    python benchmarks/metrics_overhead.py
+"""
+from common import interleaved
+from pyschema import Schema
+from six import print_ as print_out
+
+schema_dict = {
+    'display_name': 'Configuration',
+    'known_children': {
+        'name': {'type': 'string', 'display_name': 'Name'},
+        'limits': {
+            'type': 'list',
+            'display_name': 'Limits',
+            'value_schema': {'type': 'number', 'display_name': 'Limit', 'maximum_value': 1000}
+        },
+        'flags': {
+            'display_name': 'Flags',
+            'allow_unknown_children': True,
+            'value_schema': {'type': 'boolean', 'display_name': 'Flag'}
+        }
+    }
+}
+
+documents = {
+    'small document': {'name': 'x', 'limits': [1, 2, 3], 'flags': {'a': True}},
+    'medium document': {
+        'name': 'x',
+        'limits': list(range(500)),
+        'flags': dict(('f%s' % i, bool(i % 2)) for i in range(100))
+    }
+}
+
+if __name__ == '__main__':
+    plain = Schema(schema_dict)
+    metered = Schema(schema_dict, metrics=True)
+    for name, doc in sorted(documents.items()):
+        number = 2000 if name == 'small document' else 50
+        base, with_metrics = interleaved([lambda: plain.validate(doc), lambda: metered.validate(doc)], number, 100)
+        print_out('%-18s %8.2f us  %8.2f us with metrics  (%+.2f us, %+.1f%%)' % (
+            name, base * 1e6, with_metrics * 1e6, (with_metrics - base) * 1e6, (with_metrics / base - 1) * 100))
@@ -0,0 +1,94 @@
+"""
+Compare the recursive and the iterative validation engines on deep and wide documents, and
+the recursive engine with the reference (by default the original) pyschema.
+
+Run from the repository root:
+    python benchmarks/validation_engines.py [reference git revision]
+"""
+import sys
+
+from common import interleaved, load_revision
+from pyschema import Schema
+from six import print_ as print_out
+
+
+def deep_schema():
+    # A list whose values are lists of the same schema, nested to any depth
+    return Schema({
+        'type': 'ref',
+        'ref': 'Nested',
+        'definitions': {
+            'Nested': {'type': 'list', 'display_name': 'Nested', 'value_schema': {'type': 'ref', 'ref': 'Nested'}}
+        }
+    })
+
+
+def deep_document(depth):
+    doc = []
+    for _ in range(depth):
+        doc = [doc]
+    return doc
+
+
+def wide_schema(schema_class=Schema):
+    return schema_class({
+        'type': 'list',
+        'display_name': 'Records',
+        'value_schema': {
+            'display_name': 'Record',
+            'known_children': {
+                'name': {'type': 'string', 'display_name': 'Name'},
+                'age': {'type': 'number', 'display_name': 'Age', 'maximum_value': 120},
+                'tags': {
+                    'type': 'list',
+                    'display_name': 'Tags',
+                    'value_schema': {'type': 'string', 'display_name': 'Tag'}
+                }
+            },
+            'mandatory_children': ['name']
+        }
+    })
+
+
+def wide_document(width):
+    return [{'name': 'n%s' % i, 'age': i % 150, 'tags': ['a', 'b']} for i in range(width)]
+
+
+def small_document():
+    return [{'name': 'n', 'age': 10, 'tags': ['a']}, {'name': 'm', 'age': 200}]
+
+
+def run(name, schema, doc, engines, number, rounds=10):
+    functions = [lambda engine=engine: schema.validate(doc, engine=engine) for engine in engines]
+    try:
+        times = interleaved(functions, number, rounds)
+    except RuntimeError:
+        # RecursionError is a RuntimeError.  Time the engines that can validate the document.
+        for engine in engines:
+            try:
+                times = interleaved([lambda: schema.validate(doc, engine=engine)], number, rounds)
+                print_out('%-28s %-10s %10.3f ms' % (name, engine, times[0] * 1000.0))
+            except RuntimeError as ex:
+                print_out('%-28s %-10s %s' % (name, engine, type(ex).__name__))
+        return
+    for engine, seconds in zip(engines, times):
+        print_out('%-28s %-10s %10.3f ms' % (name, engine, seconds * 1000.0))
+
+
+def run_reference(name, reference, doc, number, rounds=10):
+    schema = wide_schema()
+    reference_schema = wide_schema(reference.Schema)
+    new, old = interleaved([lambda: schema.validate(doc), lambda: reference_schema.validate(doc)], number, rounds)
+    print_out('%-28s %-10s %10.3f ms  (reference %s: %.3f ms, %+.1f%%)' % (
+        name, 'recursive', new * 1000.0, reference.revision[:7], old * 1000.0, (new / old - 1) * 100))
+
+
+if __name__ == '__main__':
+    both = ('recursive', 'iterative')
+    run('deep (depth 200)', deep_schema(), deep_document(200), both, 200)
+    run('deep (depth 50000)', deep_schema(), deep_document(50000), both, 1, 3)
+    run('wide (100000 records)', wide_schema(), wide_document(100000), both, 1, 3)
+
+    reference = load_revision(sys.argv[1] if len(sys.argv) > 1 else None)
+    run_reference('small (2 records)', reference, small_document(), 2000)
+    run_reference('wide (10000 records)', reference, wide_document(10000), 3)
@@ -5,23 +5,62 @@ While using python objects is the right approach to have structured data, many a
 nevertheless use dictionaries or lists of various data and are stuck with it, specifically
 for saving configuration etc.
 """
-import re
 import os
-import jinja2
+import sys
+import time
+from bisect import bisect_left
 
-# Import all the types from six to support both PY2 and PY3
-from six import integer_types
-from six import string_types
-from six import text_type
-from six import binary_type
-from six import iteritems
+# Modules needed only by some features (re, threading, hashlib, random, jinja2, ...) are
+# imported where they are used, to keep importing this module fast.
+
+# Types to support both PY2 and PY3, the same as six provides
+if sys.version_info[0] >= 3:
+    integer_types = (int,)
+    string_types = (str,)
+    text_type = str
+    binary_type = bytes
+
+    def iteritems(d):
+        return iter(d.items())
+else:
+    integer_types = (int, long)
+    string_types = (basestring,)
+    text_type = unicode
+    binary_type = str
+
+    def iteritems(d):
+        return d.iteritems()
+
+default_timer = getattr(time, 'perf_counter', time.time)
 
 # TODO: Move all the strings to one place
 type_mismatch = 'Expecting value to be {type} but got {actual_type} for {level}'
 invalid_boolean = 'Invalid Value for boolean field'
 
+# Marker for violations that carry no offending value
+_no_value = object()
+
 default_template_dir = os.path.join(os.path.dirname(__file__), "doc_templates")
 
+# Builtins available to dynamic schema expressions given as strings.  Anything else they use
+# must be given to Schema(..., expression_namespace=...)
+expression_builtins = {
+    'None': None, 'True': True, 'False': False,
+    'abs': abs, 'all': all, 'any': any, 'bool': bool, 'dict': dict, 'enumerate': enumerate,
+    'filter': filter, 'float': float, 'int': int, 'len': len, 'list': list, 'map': map,
+    'max': max, 'min': min, 'range': range, 'reversed': reversed, 'set': set, 'sorted': sorted,
+    'str': str, 'sum': sum, 'tuple': tuple, 'zip': zip
+}
+
+# Code objects of the dynamic schema expressions, by source text
+_compiled_expressions = {}
+
+# Jinja environments for document(), by template search path
+_doc_environments = {}
+
+# Upper bounds (in seconds) of the latency histogram buckets
+latency_buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
 def get_bool(val):
     """
     Convert various True/False values to true boolean values
@@ -37,6 +76,962 @@ def get_bool(val):
         raise ValueError(invalid_boolean)
 
 
+def compile_expression(source):
+    """
+    Compile a dynamic schema expression.  Code objects are cached by source text, so
+    expressions shared by many schemas are parsed only once.
+
+    :param source: Python expression
+    :return: Code object for eval
+    """
+    code = _compiled_expressions.get(source)
+    if code is None:
+        code = compile(source, '<schema expression>', 'eval')
+        _compiled_expressions[source] = code
+    return code
+
+
+def path_to_tuple(path):
+    """
+    Convert a linked path (parent_path, key) built during validation into a tuple of keys
+
+    :param path: Linked path, () for the root
+    :return: Tuple of list indices and map keys from the root to the violating value
+    """
+    keys = []
+    while path:
+        path, key = path
+        keys.append(key)
+    keys.reverse()
+    return tuple(keys)
+
+
+class ViolationList(object):
+    """ Default violation collector. Keeps every violation message in the order found.
+    Set count_nodes to also count the violations by schema node in node_counts,
+    sampling to a SampleEstimates to validate only a sample of large collections, and
+    custom_pool to a CustomValidationRun to run the custom validations on a thread pool.
+    """
+    track_paths = False
+
+    def __init__(self):
+        self.messages = []
+        self.count_nodes = False
+        self.node_counts = None
+        self.sampling = None
+        self.custom_pool = None
+
+    def __len__(self):
+        return len(self.messages)
+
+    def position(self):
+        """
+        Position at which a violation found now goes, see insert
+        """
+        return len(self.messages)
+
+    def add(self, node, kind, message, path=None, value=_no_value):
+        self.messages.append(message)
+        if self.count_nodes:
+            # Allocated on the first violation, valid documents do not pay for it
+            if self.node_counts is None:
+                self.node_counts = {}
+            self.node_counts[node] = self.node_counts.get(node, 0) + 1
+
+    def insert(self, position, node, kind, message, path=None):
+        """
+        Add a violation found out of order, at the position it would have had otherwise
+
+        :return: Number of positions taken, to shift the positions of the violations after it
+        """
+        self.messages.insert(position, message)
+        if self.count_nodes:
+            if self.node_counts is None:
+                self.node_counts = {}
+            self.node_counts[node] = self.node_counts.get(node, 0) + 1
+        return 1
+
+    def result(self):
+        return self.messages
+
+
+class ViolationAggregator(object):
+    """ Collector that groups violations by (schema node, kind) instead of keeping every message.
+    Memory used is bounded by the size of the schema, not by the number of violations found.
+
+    Each group reports the level, the kind, the first message, the number of violations,
+    the paths of the first max_examples violations and the min/max offending values where
+    the values are comparable.
+    >>> s = Schema({'type': 'list', 'display_name': 'L', 'value_schema': {'type': 'number', 'display_name': 'N', 'maximum_value': 5}})
+    >>> s.validate([1, 7, 9, 3], aggregate=True)
+    [{'level': 'root[i](N)', 'kind': 'maximum_value', 'message': 'Value 7 is greater than 5 at root[i](N)', 'count': 2, 'samples': [(1,), (2,)], 'min_value': 7, 'max_value': 9}]
+    """
+    track_paths = True
+
+    def __init__(self, max_examples=5):
+        self.max_examples = max_examples
+        self.groups = {}
+        self.order = []
+        self.count_nodes = False
+        self.node_counts = None
+        self.sampling = None
+        self.custom_pool = None
+        self.total = 0
+
+    def __len__(self):
+        return self.total
+
+    def position(self):
+        return len(self.order)
+
+    def insert(self, position, node, kind, message, path=None):
+        # Only a new group takes a position, the violation joins its group otherwise
+        if (node, kind) in self.groups:
+            self.add(node, kind, message, path)
+            return 0
+        self.add(node, kind, message, path)
+        self.order.insert(position, self.order.pop())
+        return 1
+
+    def add(self, node, kind, message, path=None, value=_no_value):
+        group = self.groups.get((node, kind))
+        if group is None:
+            group = {
+                'level': node.level,
+                'kind': kind,
+                'message': message,
+                'count': 0,
+                'samples': []
+            }
+            self.groups[(node, kind)] = group
+            self.order.append(group)
+
+        group['count'] += 1
+        self.total += 1
+        if self.count_nodes:
+            if self.node_counts is None:
+                self.node_counts = {}
+            self.node_counts[node] = self.node_counts.get(node, 0) + 1
+        if path is not None and len(group['samples']) < self.max_examples:
+            group['samples'].append(path_to_tuple(path))
+
+        if value is not _no_value:
+            if 'min_value' not in group:
+                group['min_value'] = group['max_value'] = value
+            else:
+                try:
+                    if value < group['min_value']:
+                        group['min_value'] = value
+                    elif value > group['max_value']:
+                        group['max_value'] = value
+                except TypeError:
+                    # Values of different types can't be ordered in PY3
+                    pass
+
+    def result(self):
+        return self.order
+
+
+def _normal_quantile(p):
+    """
+    Inverse of the standard normal distribution, found by bisection on math.erf
+    """
+    import math
+
+    low, high = -10.0, 10.0
+    for _ in range(100):
+        mid = (low + high) / 2
+        if 0.5 * (1 + math.erf(mid / math.sqrt(2))) < p:
+            low = mid
+        else:
+            high = mid
+    return (low + high) / 2
+
+
+class Sampling(object):
+    """ Settings for sampling validation, see Schema.validate(data, sample=...).
+    Lists and the unknown children of maps that have more than size values are validated
+    for a sample of size values only.  Smaller ones are validated in full, and are part of the
+    estimates with all their values sampled.  Container level checks (sizes, uniqueness,
+    mandatory children) and known children of maps are still validated exactly.
+
+    Sets are sampled in sorted order, or in the order of the repr of their values when these
+    can't be compared, so that the samples do not depend on hash order.
+
+    method is 'random' for a simple random sample, or 'stratified' to pick one value at random
+    from each of size equal slices of the collection.  The seed makes the samples repeatable.
+    """
+    methods = ('random', 'stratified')
+
+    def __init__(self, size=100, seed=0, method='random', confidence=0.95):
+        if method not in self.methods:
+            raise ValueError('Unknown sampling method %s' % method)
+        if not 0 < confidence < 1:
+            raise ValueError('Confidence must be between 0 and 1')
+        if size < 1:
+            raise ValueError('Sample size must be at least 1')
+        self.size = size
+        self.seed = seed
+        self.method = method
+        self.confidence = confidence
+        self.z = _normal_quantile(0.5 + confidence / 2)
+
+    def start(self):
+        return SampleEstimates(self)
+
+
+def _ordered_values(data):
+    """
+    Values of an unordered collection in a repeatable order
+    """
+    if not isinstance(data, (set, frozenset)):
+        return list(data)
+    try:
+        return sorted(data)
+    except TypeError:
+        return sorted(data, key=repr)
+
+
+class SampleEstimates(object):
+    """ Chooses the samples during one validation, and estimates the rate of values with
+    violations for each sampled collection in the schema.
+    """
+    def __init__(self, sampling):
+        import random
+
+        self.sampling = sampling
+        self.size = sampling.size
+        self.random = random.Random(sampling.seed)
+        # Schema node -> [population, sampled, failed]
+        self.stats = {}
+        self.order = []
+        # (schema node, first, end) for sampled values whose custom validations run on a pool,
+        # first and end being the indices of their tasks in the CustomValidationRun
+        self.pending = []
+
+    def choose(self, node, population):
+        """
+        Choose the values to validate in a collection, all of them if it is not larger than the
+        sample size
+
+        :param node: Schema node of the collection
+        :param population: Number of values in the collection
+        :return: Sorted indices of the values to validate
+        """
+        size = self.size
+        if not population:
+            return []
+        if population <= size:
+            size = population
+            indices = range(population)
+        elif self.sampling.method == 'random':
+            indices = sorted(self.random.sample(range(population), size))
+        else:
+            indices = []
+            for i in range(size):
+                low = population * i // size
+                high = population * (i + 1) // size
+                indices.append(self.random.randrange(low, high))
+
+        stats = self.stats.get(node)
+        if stats is None:
+            stats = self.stats[node] = [0, 0, 0]
+            self.order.append(node)
+        stats[0] += population
+        stats[1] += size
+        return indices
+
+    def mark(self, violations):
+        """
+        Remember where the violations stand before validating a sampled value
+        """
+        custom_pool = violations.custom_pool
+        return len(violations), 0 if custom_pool is None else len(custom_pool.tasks)
+
+    def observe(self, node, violations, mark):
+        """
+        Count a sampled value as failed if violations were found since mark.  When it has custom
+        validations running on a pool it is decided once their violations are merged.
+        """
+        found, submitted = mark
+        if len(violations) > found:
+            self.stats[node][2] += 1
+        elif violations.custom_pool is not None and len(violations.custom_pool.tasks) > submitted:
+            self.pending.append((node, submitted, len(violations.custom_pool.tasks)))
+
+    def observe_custom(self, tasks):
+        """
+        Decide the sampled values left pending, given the finished custom validation tasks
+        """
+        for node, first, end in self.pending:
+            if any(tasks[i].found for i in range(first, end)):
+                self.stats[node][2] += 1
+        self.pending = []
+
+    def result(self):
+        """
+        Estimated rate of values with violations for each sampled collection.  The bounds are a
+        Wilson score interval, with a finite population correction.
+        """
+        import math
+
+        z = self.sampling.z
+        estimates = []
+        for node in self.order:
+            population, sampled, failed = self.stats[node]
+            rate = float(failed) / sampled
+            if sampled >= population:
+                lower = upper = rate
+            else:
+                n = sampled * float(population - 1) / (population - sampled)
+                denominator = 1 + z * z / n
+                center = (rate + z * z / (2 * n)) / denominator
+                margin = z * math.sqrt(rate * (1 - rate) / n + z * z / (4 * n * n)) / denominator
+                lower = max(0.0, center - margin) if failed else 0.0
+                upper = min(1.0, center + margin) if failed < sampled else 1.0
+            estimates.append({
+                'level': node.level,
+                'population': population,
+                'sampled': sampled,
+                'failed': failed,
+                'rate': rate,
+                'lower': lower,
+                'upper': upper,
+                'confidence': self.sampling.confidence
+            })
+        return estimates
+
+
+class CustomValidationPool(object):
+    """ Runs the custom validations on a pool of threads, see Schema.validate(data, custom_pool=...).
+    Custom validations then overlap with the rest of the validation and with each other.  Their
+    violations are merged back in the order they would have had if run inline.
+
+    A custom validation that takes more than timeout seconds once started is reported as a
+    violation instead of being waited for.  The thread running it can't be stopped and runs to
+    completion in the background.  Calls still queued are reported the same way only when every
+    worker is busy with a call over the timeout.
+
+    timing_report() gives the calls, total and maximum seconds, and timeouts of each validator.
+    Requires concurrent.futures (the futures package on PY2).
+    """
+    def __init__(self, max_workers=4, timeout=None):
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.timings = {}
+        # Tasks being run by the workers
+        self.running = set()
+        self._lock = threading.Lock()
+
+    def start(self):
+        return CustomValidationRun(self)
+
+    def _timing(self, name):
+        timing = self.timings.get(name)
+        if timing is None:
+            timing = self.timings[name] = {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'timeouts': 0}
+        return timing
+
+    def task_started(self, task):
+        with self._lock:
+            task.started = default_timer()
+            self.running.add(task)
+
+    def task_finished(self, task):
+        seconds = default_timer() - task.started
+        with self._lock:
+            self.running.discard(task)
+            # A call that timed out was reported as such, it is not counted again
+            if not task.timed_out:
+                timing = self._timing(task.node.custom_validation.__name__)
+                timing['calls'] += 1
+                timing['seconds'] += seconds
+                timing['max_seconds'] = max(timing['max_seconds'], seconds)
+
+    def task_timed_out(self, task):
+        with self._lock:
+            task.timed_out = True
+            self._timing(task.node.custom_validation.__name__)['timeouts'] += 1
+
+    def stuck_at(self):
+        """
+        :return: Time from which every worker is busy with a call over its time budget, or None
+            if some worker is free
+        """
+        with self._lock:
+            if len(self.running) < self.max_workers:
+                return None
+            return max(x.started for x in self.running) + self.timeout
+
+    def timing_report(self):
+        with self._lock:
+            return dict((k, dict(v)) for k, v in iteritems(self.timings))
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait)
+
+
+class _CustomValidationTask(object):
+    def __init__(self, node, data, path, position):
+        self.node = node
+        self.data = data
+        self.path = path
+        self.position = position
+        self.started = None
+        self.future = None
+        self.timed_out = False
+        # Number of violations found, once finished
+        self.found = 0
+
+    def run(self, pool):
+        pool.task_started(self)
+        try:
+            return list(self.node.custom_validation(self.data))
+        finally:
+            pool.task_finished(self)
+
+
+class CustomValidationRun(object):
+    """ The custom validations submitted to a CustomValidationPool during one validation.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self.tasks = []
+        self.timed_out = False
+
+    def submit(self, node, data, violations, path):
+        task = _CustomValidationTask(node, data, path, violations.position())
+        task.future = self.pool.executor.submit(task.run, self.pool)
+        self.tasks.append(task)
+
+    def _wait(self, task):
+        """
+        Wait for a task within its time budget, timeout seconds from the time it started.  A task
+        still queued is given up only if every worker is busy with a call over its own budget.
+
+        :return: Violations found by the custom validation, or None if it timed out
+        """
+        from concurrent.futures import wait
+
+        timeout = self.pool.timeout
+        while not task.future.done():
+            if timeout is None:
+                wait([task.future])
+                continue
+
+            now = default_timer()
+            if task.started is not None:
+                remaining = task.started + timeout - now
+                if remaining <= 0:
+                    return None
+            else:
+                stuck_at = self.pool.stuck_at()
+                # Cancelling fails if it has just started, its own budget applies then
+                if stuck_at is not None and stuck_at <= now and task.future.cancel():
+                    return None
+                # Look again once it may have started, or once the workers may be stuck
+                remaining = timeout if stuck_at is None else min(timeout, stuck_at - now)
+            wait([task.future], max(remaining, 0))
+        return task.future.result()
+
+    def finish(self, violations):
+        """
+        Wait for the custom validations and add their violations to the collector
+        """
+        added = 0
+        for task in self.tasks:
+            node = task.node
+            name = node.custom_validation.__name__
+            results = self._wait(task)
+            if results is None:
+                self.pool.task_timed_out(task)
+                self.timed_out = True
+                found = [('custom_timeout', "%s: timed out after %s seconds at %s" % (name, self.pool.timeout, node.level))]
+            else:
+                found = [('custom', "%s: %s at %s" % (name, x, node.level)) for x in results]
+
+            task.found = len(found)
+            for kind, message in found:
+                added += violations.insert(task.position + added, node, kind, message, task.path)
+
+        if violations.sampling is not None:
+            violations.sampling.observe_custom(self.tasks)
+
+
+class _MetricsShard(object):
+    """ Metrics recorded by a single thread.  Only the owning thread writes to a shard.
+    """
+    def __init__(self):
+        self.counters = {
+            'validations': 0,
+            'invalid_documents': 0,
+            'violations': 0,
+            'realizations': 0,
+            'dynamic_expansions': 0,
+            'cache_hits': 0
+        }
+        self.node_violations = {}
+        # Expression source -> [evaluations, seconds]
+        self.expressions = {}
+        self.histograms = {
+            'validate_seconds': [0.0, [0] * (len(latency_buckets) + 1)],
+            'realize_seconds': [0.0, [0] * (len(latency_buckets) + 1)]
+        }
+        # Recorded on every validate() call, looked up once here
+        self.validate_histogram = self.histograms['validate_seconds']
+
+    def observe(self, name, seconds):
+        histogram = self.histograms[name]
+        histogram[0] += seconds
+        histogram[1][bisect_left(latency_buckets, seconds)] += 1
+
+    def merge(self, shard):
+        """
+        Add the metrics of another shard to this one
+        """
+        for k, v in iteritems(shard.counters):
+            self.counters[k] += v
+        for k, v in list(iteritems(shard.node_violations)):
+            self.node_violations[k] = self.node_violations.get(k, 0) + v
+        for k, (count, seconds) in list(iteritems(shard.expressions)):
+            timing = self.expressions.setdefault(k, [0, 0.0])
+            timing[0] += count
+            timing[1] += seconds
+        for k, (total, counts) in iteritems(shard.histograms):
+            histogram = self.histograms[k]
+            histogram[0] += total
+            histogram[1][:] = [a + b for a, b in zip(histogram[1], counts)]
+
+
+class ValidationMetrics(object):
+    """ Counters and latency histograms for a schema, enabled with Schema(schema_dict, metrics=True).
+    Each thread records into its own shard, so recording takes no locks.  Shards are merged
+    when a snapshot is taken, and the shards of finished threads are folded into a single one.
+    >>> s = Schema({'type': 'number', 'display_name': 'Age', 'maximum_value': 120}, metrics=True)
+    >>> s.validate(200)
+    ['Value 200 is greater than 120 at root(Age)']
+    >>> s.metrics.snapshot()['node_violations']
+    {'root(Age)': 1}
+    """
+    counter_help = {
+        'validations': 'Documents validated',
+        'invalid_documents': 'Documents with at least one violation',
+        'violations': 'Violations found',
+        'realizations': 'Calls to realize the schema',
+        'dynamic_expansions': 'Dynamic schema expansions evaluated',
+        'cache_hits': 'Documents whose result was found in the validation cache'
+    }
+    histogram_help = {
+        'validate_seconds': 'Time taken to validate a document',
+        'realize_seconds': 'Time taken to realize the schema'
+    }
+
+    def __init__(self, name):
+        import threading
+
+        self.name = name
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        # (weak reference to the thread, shard) for each thread that recorded metrics
+        self._shards = []
+        self._finished = _MetricsShard()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            import threading
+            import weakref
+
+            shard = self._local.shard = _MetricsShard()
+            with self._lock:
+                self._fold_finished()
+                self._shards.append((weakref.ref(threading.current_thread()), shard))
+            return shard
+
+    def _fold_finished(self):
+        # Threads that are gone no longer write to their shards
+        running = []
+        for thread_ref, shard in self._shards:
+            thread = thread_ref()
+            if thread is None or not thread.is_alive():
+                self._finished.merge(shard)
+            else:
+                running.append((thread_ref, shard))
+        self._shards = running
+
+    def count(self, name, value=1):
+        self._shard().counters[name] += value
+
+    def record_validation(self, seconds, node_counts):
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._shard()
+        shard.counters['validations'] += 1
+        histogram = shard.validate_histogram
+        histogram[0] += seconds
+        histogram[1][bisect_left(latency_buckets, seconds)] += 1
+        if node_counts:
+            counters = shard.counters
+            counters['invalid_documents'] += 1
+            node_violations = shard.node_violations
+            for node, count in iteritems(node_counts):
+                counters['violations'] += count
+                node_violations[node.level] = node_violations.get(node.level, 0) + count
+
+    def record_cache_hit(self, seconds, violations):
+        """
+        Record a validation answered from the cache.  Its violations are not counted by node.
+        """
+        shard = self._shard()
+        counters = shard.counters
+        counters['validations'] += 1
+        counters['cache_hits'] += 1
+        shard.observe('validate_seconds', seconds)
+        if violations:
+            counters['invalid_documents'] += 1
+            counters['violations'] += violations
+
+    def record_expression(self, source, seconds):
+        try:
+            shard = self._local.shard
+        except AttributeError:
+            shard = self._shard()
+        timing = shard.expressions.get(source)
+        if timing is None:
+            timing = shard.expressions[source] = [0, 0.0]
+        timing[0] += 1
+        timing[1] += seconds
+
+    def record_realization(self, seconds):
+        shard = self._shard()
+        shard.counters['realizations'] += 1
+        shard.observe('realize_seconds', seconds)
+
+    def reset(self):
+        import threading
+
+        with self._lock:
+            self._shards = []
+            self._finished = _MetricsShard()
+            self._local = threading.local()
+
+    def snapshot(self):
+        """
+        Merge the metrics recorded by all threads
+
+        :return: Dictionary with the counters, violations by node level, evaluations and time taken
+            by dynamic schema expressions given as strings, and the histograms.  Histogram
+            buckets are (upper bound, cumulative count) pairs, the last upper bound being infinity.
+        """
+        merged = _MetricsShard()
+        with self._lock:
+            self._fold_finished()
+            merged.merge(self._finished)
+            shards = [shard for _, shard in self._shards]
+        for shard in shards:
+            merged.merge(shard)
+
+        snapshot = {
+            'schema': self.name,
+            'node_violations': merged.node_violations,
+            'expressions': dict((k, {'evaluations': v[0], 'seconds': v[1]}) for k, v in iteritems(merged.expressions))
+        }
+        snapshot.update(merged.counters)
+        for k, (total, counts) in iteritems(merged.histograms):
+            buckets = []
+            cumulative = 0
+            for upper_bound, count in zip(latency_buckets + (float('inf'),), counts):
+                cumulative += count
+                buckets.append((upper_bound, cumulative))
+            snapshot[k] = {'sum': total, 'count': cumulative, 'buckets': buckets}
+        return snapshot
+
+    def to_prometheus(self):
+        """
+        Export a snapshot in the Prometheus text exposition format
+        """
+        return prometheus_text([self])
+
+
+def _prometheus_label(value):
+    return text_type(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text(metrics_list):
+    """
+    Export the metrics of several schemas in the Prometheus text exposition format
+
+    :param metrics_list: ValidationMetrics objects, usually one per schema
+    :return: Text to serve to Prometheus
+    """
+    snapshots = [x.snapshot() for x in metrics_list]
+    lines = []
+    for name in sorted(ValidationMetrics.counter_help):
+        lines.append('# HELP pyschema_%s_total %s' % (name, ValidationMetrics.counter_help[name]))
+        lines.append('# TYPE pyschema_%s_total counter' % name)
+        for snapshot in snapshots:
+            lines.append('pyschema_%s_total{schema="%s"} %s' % (name, _prometheus_label(snapshot['schema']), snapshot[name]))
+
+    lines.append('# HELP pyschema_node_violations_total Violations found by schema node')
+    lines.append('# TYPE pyschema_node_violations_total counter')
+    for snapshot in snapshots:
+        for level, count in sorted(iteritems(snapshot['node_violations'])):
+            lines.append('pyschema_node_violations_total{schema="%s",level="%s"} %s' %
+                         (_prometheus_label(snapshot['schema']), _prometheus_label(level), count))
+
+    lines.append('# HELP pyschema_expression_evaluations_total Evaluations of dynamic schema expressions')
+    lines.append('# TYPE pyschema_expression_evaluations_total counter')
+    for snapshot in snapshots:
+        for source, timing in sorted(iteritems(snapshot['expressions'])):
+            lines.append('pyschema_expression_evaluations_total{schema="%s",expression="%s"} %s' %
+                         (_prometheus_label(snapshot['schema']), _prometheus_label(source), timing['evaluations']))
+    lines.append('# HELP pyschema_expression_seconds_total Time taken to evaluate dynamic schema expressions')
+    lines.append('# TYPE pyschema_expression_seconds_total counter')
+    for snapshot in snapshots:
+        for source, timing in sorted(iteritems(snapshot['expressions'])):
+            lines.append('pyschema_expression_seconds_total{schema="%s",expression="%s"} %r' %
+                         (_prometheus_label(snapshot['schema']), _prometheus_label(source), timing['seconds']))
+
+    for name in sorted(ValidationMetrics.histogram_help):
+        lines.append('# HELP pyschema_%s %s' % (name, ValidationMetrics.histogram_help[name]))
+        lines.append('# TYPE pyschema_%s histogram' % name)
+        for snapshot in snapshots:
+            schema = _prometheus_label(snapshot['schema'])
+            histogram = snapshot[name]
+            for upper_bound, count in histogram['buckets']:
+                le = '+Inf' if upper_bound == float('inf') else repr(upper_bound)
+                lines.append('pyschema_%s_bucket{schema="%s",le="%s"} %s' % (name, schema, le, count))
+            lines.append('pyschema_%s_sum{schema="%s"} %r' % (name, schema, histogram['sum']))
+            lines.append('pyschema_%s_count{schema="%s"} %s' % (name, schema, histogram['count']))
+    return '\n'.join(lines) + '\n'
+
+
+def document_fingerprint(data):
+    """
+    Compute a fingerprint of a document made of dictionaries, lists and scalars.  Documents
+    with the same fingerprint get the same validation result.
+
+    :param data: Document
+    :return: Hex digest
+    """
+    import hashlib
+
+    digest = hashlib.sha1()
+    try:
+        digest.update(repr(data).encode('utf-8', 'surrogatepass'))
+    except RuntimeError:
+        # Nested too deep for repr (RecursionError), walk the document instead
+        digest = hashlib.sha1()
+        stack = [data]
+        while stack:
+            value = stack.pop()
+            if isinstance(value, dict):
+                digest.update(('{%s:' % len(value)).encode('utf-8'))
+                items = []
+                for k, v in iteritems(value):
+                    items.append(k)
+                    items.append(v)
+                stack.extend(reversed(items))
+            elif isinstance(value, (list, tuple, set, frozenset)):
+                digest.update(('%s[%s:' % (type(value).__name__, len(value))).encode('utf-8'))
+                stack.extend(reversed(list(value)))
+            else:
+                digest.update(('%s(%r)' % (type(value).__name__, value)).encode('utf-8', 'surrogatepass'))
+    return digest.hexdigest()
+
+
+class ValidationCache(object):
+    """ LRU cache of validation results, enabled with Schema(schema_dict, cache=...).
+    Results are keyed by a version (or etag) given to validate(), or by the fingerprint
+    of the document.  The least recently used results are evicted when there are more than
+    max_entries of them, or when they hold more than max_size violations in total.
+
+    A cache can be shared by several schemas.  Their results are kept apart, and the results
+    of a schema are dropped whenever it changes: when it is realized again or when dynamic
+    schema is evaluated.
+    """
+    def __init__(self, max_entries=128, max_size=None):
+        import threading
+        import weakref
+        from collections import OrderedDict
+
+        self.max_entries = max_entries
+        self.max_size = max_size
+        # (owner, key) -> (result, size)
+        self.entries = OrderedDict()
+        self.size = 0
+        # Owner -> generation of its cached results
+        self.generations = weakref.WeakKeyDictionary()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, owner, key, generation):
+        """
+        :param owner: Schema context the result belongs to
+        :return: (copy of the cached result, number of violations), or None if there is none for the key
+        """
+        import copy
+
+        with self._lock:
+            self._check_generation(owner, generation)
+            entry = self.entries.pop((owner, key), None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries[(owner, key)] = entry
+            self.hits += 1
+        return copy.deepcopy(entry[0]), entry[1]
+
+    def put(self, owner, key, result, size, generation):
+        import copy
+
+        result = copy.deepcopy(result)
+        with self._lock:
+            self._check_generation(owner, generation)
+            old = self.entries.pop((owner, key), None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[(owner, key)] = (result, size)
+            self.size += size
+            while self.entries and (len(self.entries) > self.max_entries or
+                                    (self.max_size is not None and self.size > self.max_size)):
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.size = 0
+
+    def _check_generation(self, owner, generation):
+        # Drop the results of an owner that changed since they were cached
+        if self.generations.get(owner) == generation:
+            return
+        self.generations[owner] = generation
+        for entry_key in [x for x in self.entries if x[0] is owner]:
+            self.size -= self.entries.pop(entry_key)[1]
+
+
+class SchemaContext(object):
+    """ State shared by all the nodes of one schema.  Holds the named definitions, each
+    built into a single SchemaNode the first time it is referenced with
+    {'type': 'ref', 'ref': name}.  References to a definition from within itself make
+    recursive schemas.
+    >>> s = Schema({
+    ...     'type': 'ref', 'ref': 'Menu',
+    ...     'definitions': {
+    ...         'Menu': {'display_name': 'Menu', 'known_children': {
+    ...             'items': {'type': 'list', 'display_name': 'Items', 'value_schema': {'type': 'ref', 'ref': 'Menu'}}}}
+    ...     }})
+    >>> s.validate({'items': [{'items': []}, {'items': [{'items': 10}]}]})
+    ["Expecting value to be (<class 'list'>, <class 'set'>, <class 'tuple'>) but got <class 'int'> for Menu.items(Items)"]
+    """
+    def __init__(self, definitions=None, metrics=None, expression_namespace=None):
+        self.definitions = definitions or {}
+        self.metrics = metrics
+        self.expression_namespace = expression_namespace or {}
+        # Changes whenever the schema may have changed, to invalidate cached results
+        self.generation = 0
+        self.nodes = {}
+        self._resolving = set()
+
+    def resolve(self, name, level):
+        """
+        Get the node for a definition, creating it on first use
+
+        :param name: Name of the definition
+        :param level: Level of the reference, for error messages
+        :return: Shared schema node
+        """
+        node = self.nodes.get(name)
+        if node is not None:
+            return node
+
+        if name not in self.definitions:
+            raise SchemaError('Unknown definition %s referenced at %s' % (name, level))
+        if name in self._resolving:
+            raise SchemaError('Definition %s refers to itself without defining a schema at %s' % (name, level))
+
+        self._resolving.add(name)
+        try:
+            node = SchemaNode.create_schema_node(name, self.definitions[name], self, name)
+        finally:
+            self._resolving.discard(name)
+        # Aliases (definitions that are references themselves) share the referenced node
+        self.nodes[name] = node
+        return node
+
+    def evaluate(self, source):
+        """
+        Evaluate a dynamic schema expression given as a string.  Expressions see only the
+        expression_builtins and the names in the expression namespace of the schema.
+
+        :param source: Python expression
+        :return: Value of the expression
+        """
+        code = compile_expression(source)
+        namespace = dict(self.expression_namespace)
+        namespace['__builtins__'] = expression_builtins
+
+        if self.metrics is None:
+            return eval(code, namespace)
+        start = default_timer()
+        try:
+            return eval(code, namespace)
+        finally:
+            self.metrics.record_expression(source, default_timer() - start)
+
+    def realize_definitions(self):
+        """
+        Realize the schema of every definition referenced so far.  Realizing a definition may
+        reference more definitions, so keep going until all of them are done.
+
+        :return: Dictionary of realized schema by definition name
+        """
+        realized = {}
+        pending = list(self.nodes)
+        while pending:
+            name = pending.pop()
+            if name in realized:
+                continue
+            realized[name] = {}
+            node = self.nodes[name]
+            if node.definition == name:
+                node.realize_schema(realized[name])
+            else:
+                node.realize_as_child(realized[name])
+            pending.extend(x for x in self.nodes if x not in realized)
+        return realized
+
+
+def _doc_environment(search_path):
+    """
+    Get the jinja environment used to render documentation.  jinja2 is imported on first
+    use only, as validation doesn't need it.
+
+    :param search_path: Tuple of template directories
+    :return: jinja2.Environment
+    """
+    jinja_env = _doc_environments.get(search_path)
+    if jinja_env is None:
+        import jinja2
+
+        jinja_env = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(list(search_path)),
+            autoescape=True
+        )
+        jinja_env.filters['strip_disp_name'] = lambda x: x.split('(')[0]
+        _doc_environments[search_path] = jinja_env
+    return jinja_env
+
+
 class Schema(object):
     """ Basic class through which data validation can be done.
     Create a schema object by providing schema dictionary as argument.  Once the schema
@@ -50,32 +1045,141 @@ class Schema(object):
     >>> s.realize()
     {'type': 'string', 'allow_none': False, 'display_name': 'Root', 'description': ''}
     """
-    def __init__(self, schema_dict):
-        self.root = SchemaNode.create_schema_node('root', schema_dict)
+    def __init__(self, schema_dict, metrics=False, cache=None, expression_namespace=None):
+        """
+        :param schema_dict: Schema definition
+        :param metrics: Record validation metrics in self.metrics (see ValidationMetrics).  Give a
+            string to name the metrics, they are named after the root display_name otherwise.
+        :param cache: ValidationCache, or its max_entries, to cache the validation results
+        :param expression_namespace: Names available to dynamic schema expressions given as strings
+        """
+        if cache is None or cache is False:
+            self.cache = None
+        elif isinstance(cache, ValidationCache):
+            self.cache = cache
+        elif cache is True:
+            self.cache = ValidationCache()
+        else:
+            self.cache = ValidationCache(cache)
 
-    def validate(self, data):
-        return self.root.validate(data)
+        schema_dict = schema_dict.copy()
+        if metrics:
+            self.metrics = ValidationMetrics(metrics if isinstance(metrics, string_types) else None)
+        else:
+            self.metrics = None
+        self.context = SchemaContext(schema_dict.pop('definitions', None), self.metrics, expression_namespace)
+        self.root = SchemaNode.create_schema_node('root', schema_dict, self.context)
+        if self.metrics is not None and self.metrics.name is None:
+            # The root may be a reference, name the metrics after the node it resolves to
+            self.metrics.name = self.root.display_name
+        # Build the definitions that are not referenced too, so that errors in them show up
+        for name in sorted(self.context.definitions):
+            self.context.resolve(name, 'definitions')
+
+    def validate(self, data, aggregate=False, max_examples=5, engine='recursive', sample=None, version=None,
+                 custom_pool=None):
+        """
+        Validate the data against the schema
+
+        :param data: Document to validate
+        :param aggregate: Group the violations by schema node and kind (see ViolationAggregator)
+            instead of listing each of them.  Use for large lists and maps.
+        :param max_examples: Number of sample paths kept per group when aggregating
+        :param engine: 'recursive' (default) or 'iterative'.  The iterative engine uses an explicit
+            work stack and can validate documents nested deeper than the recursion limit.
+        :param sample: Sampling settings, or just the sample size, to validate only samples of
+            large collections (see Sampling)
+        :param version: Version or etag of the document, used as the key of the cached result
+            instead of the document fingerprint when the schema has a cache
+        :param custom_pool: CustomValidationPool to run the custom validations on, concurrently
+            with the rest of the validation and with a time budget for each call
+        :return: List of violation messages, or list of violation groups when aggregating.
+            When sampling, a dictionary with these as 'violations' and the estimated violation
+            rates of the sampled collections as 'estimates'.
+        """
+        metrics = self.metrics
+        if metrics is not None:
+            start = default_timer()
+
+        cache = self.cache
+        if cache is not None:
+            if isinstance(sample, Sampling):
+                sample_key = (sample.size, sample.seed, sample.method, sample.confidence)
+            else:
+                sample_key = sample
+            if version is None:
+                cache_key = ('fingerprint', document_fingerprint(data), aggregate, max_examples, sample_key,
+                             custom_pool is not None)
+            else:
+                cache_key = ('version', version, aggregate, max_examples, sample_key, custom_pool is not None)
+            cached = cache.get(self.context, cache_key, self.context.generation)
+            if cached is not None:
+                if metrics is not None:
+                    metrics.record_cache_hit(default_timer() - start, cached[1])
+                return cached[0]
+
+        if aggregate:
+            violations = ViolationAggregator(max_examples)
+        else:
+            violations = ViolationList()
+        if metrics is not None:
+            violations.count_nodes = True
+        if sample is not None:
+            if not isinstance(sample, Sampling):
+                sample = Sampling(sample)
+            violations.sampling = sample.start()
+        if custom_pool is not None:
+            violations.custom_pool = custom_pool.start()
+        path = () if violations.track_paths else None
+
+        if engine == 'recursive':
+            self.root.check(data, violations, path)
+        elif engine == 'iterative':
+            self.root.check_iterative(data, violations, path)
+        else:
+            raise ValueError('Unknown validation engine %s' % engine)
+        if custom_pool is not None:
+            violations.custom_pool.finish(violations)
+
+        if metrics is not None:
+            metrics.record_validation(default_timer() - start, violations.node_counts)
+        if sample is not None:
+            result = {'violations': violations.result(), 'estimates': violations.sampling.result()}
+        else:
+            result = violations.result()
+
+        # Results with custom validations that timed out may differ next time, they are not cached
+        if cache is not None and not (custom_pool is not None and violations.custom_pool.timed_out):
+            cache.put(self.context, cache_key, result, len(violations), self.context.generation)
+        return result
 
     def realize(self):
+        if self.metrics is not None:
+            start = default_timer()
+
+        # Realizing again may change the schema, so cached results are no longer valid
+        self.context.generation += 1
+
         realized_schema = {}
-        self.root.realize_schema(realized_schema)
+        self.root.realize_as_child(realized_schema)
+        definitions = self.context.realize_definitions()
+        if definitions:
+            realized_schema['definitions'] = definitions
+
+        if self.metrics is not None:
+            self.metrics.record_realization(default_timer() - start)
         return realized_schema
     
     def document(self, template_directory=None):
         self.realize()
         
         if template_directory:
-            search_path = [template_directory, default_template_dir]
+            search_path = (template_directory, default_template_dir)
         else:
-            search_path = [default_template_dir]
-        jinja_env = jinja2.Environment(
-            loader=jinja2.FileSystemLoader(search_path), 
-            autoescape=True
-        )
-        jinja_env.filters['strip_disp_name'] = lambda x: x.split('(')[0]
-        
-        template =  jinja_env.get_template("overall2.html")
-        return template.render(root = self.root)
+            search_path = (default_template_dir,)
+
+        template = _doc_environment(search_path).get_template("overall2.html")
+        return template.render(root = self.root, definitions = sorted(iteritems(self.context.nodes)))
     
 class SchemaNode(object):
     allowed_expansions = {
@@ -87,8 +1191,11 @@ class SchemaNode(object):
     }
     expected_types = None
     type = None
+    # Name of the definition, for nodes shared through references
+    definition = None
 
-    def __init__(self, level, schema_dict):
+    def __init__(self, level, schema_dict, context=None):
+        self.context = context if context is not None else SchemaContext()
         self.level = level
         self._level = level
         try:
@@ -113,11 +1220,12 @@ class SchemaNode(object):
             executed = True
             if callable(code_like):
                 ret_value = code_like()
-            elif isinstance(code_like, basestring):
+            elif isinstance(code_like, string_types):
                 try:
-                    ret_value = eval(code_like)
-                except:
-                    raise SchemaError("Guessed the value of (%s) at %s to be code, but evaluation failed" % (code_like, self.level))
+                    ret_value = self.context.evaluate(code_like)
+                except Exception as ex:
+                    raise SchemaError("Guessed the value of (%s) at %s to be code, but evaluation failed: %s: %s" %
+                                      (code_like, self.level, type(ex).__name__, ex))
             else:
                 raise SchemaError("Don't known how to execute dynamic schema at %s (expected type = %s, actual type =%s)" % (self.level,expected_type, type(code_like)))
 
@@ -135,6 +1243,9 @@ class SchemaNode(object):
                     obj, executed = self._execute_if_necessary(obj, expected_type)
                     if executed:
                         setattr(self, key_name, obj)
+                        self.context.generation += 1
+                        if self.context.metrics is not None:
+                            self.context.metrics.count('dynamic_expansions')
                 except SchemaError:
                     raise
                 #except Exception as ex:
@@ -159,6 +1270,19 @@ class SchemaNode(object):
             attrs['custom_validation']['enabled'] = True
             attrs['custom_validation']['info'] = self.custom_validation.__doc__
 
+    def realize_as_child(self, attrs):
+        """
+        Realize the schema of this node as seen from its parent.  Definitions are realized
+        only once, see SchemaContext.realize_definitions, and appear as references elsewhere.
+        """
+        if self.definition is None:
+            self.realize_schema(attrs)
+        else:
+            if not self.realized:
+                self._realize_node()
+            attrs['type'] = 'ref'
+            attrs['ref'] = self.definition
+
     def validate(self, data):
         """
         Validate the data and return the violations found
@@ -166,38 +1290,121 @@ class SchemaNode(object):
         :param data:
         :return: List of violations.  Each violation is basically a string, and it is unstructured.
         """
+        violations = ViolationList()
+        self.check(data, violations)
+        return violations.result()
+
+    def check(self, data, violations, path=None):
+        """
+        Validate the data and report the violations found to the collector.  Child values are
+        validated recursively, see check_iterative for documents nested too deep for recursion.
+
+        :param data:
+        :param violations: Collector (ViolationList, ViolationAggregator) receiving the violations
+        :param path: Linked path (parent_path, key) of the data, or None if paths are not tracked
+        :return:
+        """
+        if self.check_value(data, violations, path):
+            self.validate_data(data, violations, path)
+            if self.custom_validation:
+                self.check_custom(data, violations, path)
+
+    def check_iterative(self, data, violations, path=None):
+        """
+        Same as check, but walks the schema and the data with an explicit work stack instead of
+        recursion.  Violations are reported in the same order, and nesting depth is limited only
+        by the memory available.
+
+        :param data:
+        :param violations: Collector (ViolationList, ViolationAggregator) receiving the violations
+        :param path: Linked path (parent_path, key) of the data, or None if paths are not tracked
+        :return:
+        """
+        children = self.check_node(data, violations, path)
+        if children is None:
+            return
+
+        # Each frame is a node whose children are being visited.  Once the children are
+        # exhausted the node is finished with its custom validation.
+        stack = [(self, data, path, iter(children))]
+        while stack:
+            node, value, node_path, children = stack[-1]
+            for child, child_value, child_path in children:
+                grand_children = child.check_node(child_value, violations, child_path)
+                if grand_children is None:
+                    continue
+                if grand_children:
+                    stack.append((child, child_value, child_path, iter(grand_children)))
+                    break
+                if child.custom_validation:
+                    child.check_custom(child_value, violations, child_path)
+            else:
+                stack.pop()
+                if node.custom_validation:
+                    node.check_custom(value, violations, node_path)
+
+    def check_value(self, data, violations, path):
+        """
+        Perform the checks common to all nodes (null and type)
+
+        :return: True if the data is to be validated further
+        """
         # Realize if necessary
         if not self.realized:
             self._realize_node()
 
         if data is None:
-            if self.allow_none:
-                return [ ]
-            else:
-                return [
-                    "Null is not allowed at level %s" % self.level
-                ]
+            if not self.allow_none:
+                violations.add(self, 'null', "Null is not allowed at level %s" % self.level, path)
+            return False
 
         # Perform common validation
         if not isinstance(data, self.expected_types):
-            return [
-                type_mismatch.format(type=str(self.expected_types),
-                                     actual_type = str(type(data)),
-                                     level=self.level)
-            ]
-
-        # Perform node specific validation
-        schema_errors =  self.validate_data(data)
+            violations.add(self, 'type', type_mismatch.format(type=str(self.expected_types),
+                                                              actual_type = str(type(data)),
+                                                              level=self.level), path)
+            return False
+
+        return True
+
+    def check_node(self, data, violations, path):
+        """
+        Perform the checks for this node, except the custom validation, for the iterative engine.
+
+        :return: None if the data is not to be looked into any further.  Otherwise an iterable
+            of (schema node, value, path) for the children to validate next.  Checks done after
+            the children (like uniqueness) run once the iterable is exhausted.
+        """
+        if not self.check_value(data, violations, path):
+            return None
+        return self.walk_data(data, violations, path)
+
+    def check_custom(self, data, violations, path):
         if self.custom_validation:
-            schema_errors.extend("%s: %s at %s" % (self.custom_validation.__name__, x, self.level) for x in self.custom_validation(data))
+            if violations.custom_pool is not None:
+                violations.custom_pool.submit(self, data, violations, path)
+                return
+            for x in self.custom_validation(data):
+                violations.add(self, 'custom', "%s: %s at %s" % (self.custom_validation.__name__, x, self.level), path)
 
-        return schema_errors
-    
     def get_target(self):
         return self.level.split('(')[0].replace('.','_')
     
-    def validate_data(self, data):
+    def validate_data(self, data, violations, path):
+        """
+        Node specific validation.  Container nodes validate their children recursively.
+        """
         raise SchemaError('CODE ERROR: Each child node must implement this method')
+
+    def walk_data(self, data, violations, path):
+        """
+        Node specific validation for the iterative engine.  Container nodes override this with
+        a generator yielding (schema node, value, path) for each child instead of recursing.
+
+        :return: Iterable of the children to validate
+        """
+        self.validate_data(data, violations, path)
+        return ()
     
     # methods related to documentation
     def get_short_decoration(self):
@@ -213,24 +1420,40 @@ class SchemaNode(object):
         return {}
     
     @staticmethod
-    def create_schema_node(level, schema_dict):
+    def create_schema_node(level, schema_dict, context=None, definition=None):
+        if context is None:
+            context = SchemaContext()
+
         # Get the type of the node and create the object
         schema_dict = schema_dict.copy()
         node_type = schema_dict.pop('type', 'map')
-        if node_type == 'map':
-            schema_node = MapNode(level, schema_dict)
-        elif node_type == 'string':
-            schema_node = StringNode(level, schema_dict)
-        elif node_type == 'number':
-            schema_node = NumberNode(level, schema_dict)
-        elif node_type == 'list':
-            schema_node = ListNode(level, schema_dict)
-        elif node_type == 'boolean':
-            schema_node = BooleanNode(level, schema_dict)
-        elif node_type == 'any':
-            schema_node = AnyNode(level, schema_dict)
+        if node_type == 'ref':
+            if 'ref' not in schema_dict:
+                raise SchemaError('ref is mandatory for a reference at level %s' % level)
+            schema_node = context.resolve(schema_dict.pop('ref'), level)
         else:
-            raise SchemaError('Unknown type at level %s' % level)
+            if node_type == 'map':
+                node_class = MapNode
+            elif node_type == 'string':
+                node_class = StringNode
+            elif node_type == 'number':
+                node_class = NumberNode
+            elif node_type == 'list':
+                node_class = ListNode
+            elif node_type == 'boolean':
+                node_class = BooleanNode
+            elif node_type == 'any':
+                node_class = AnyNode
+            else:
+                raise SchemaError('Unknown type at level %s' % level)
+
+            # A definition is registered before its children are created, so that references
+            # to it from within itself resolve to this very node
+            schema_node = node_class.__new__(node_class)
+            if definition is not None:
+                schema_node.definition = definition
+                context.nodes[definition] = schema_node
+            schema_node.__init__(level, schema_dict, context)
 
         # We must have consumed every key in the dictionary
         if len(schema_dict) > 0:
@@ -243,8 +1466,8 @@ class SchemaNode(object):
 class AnyNode(SchemaNode):
     expected_types = (string_types, text_type, list, dict, set, tuple, integer_types, float)
 
-    def validate_data(self, data):
-        return [ ]
+    def validate_data(self, data, violations, path):
+        pass
     
     def get_short_decoration(self):
         return "*"
@@ -259,11 +1482,15 @@ class StringNode(SchemaNode):
     expected_types = (string_types, text_type)
     type = 'string'
 
-    def __init__(self, level, schema_dict):
-        super(StringNode, self).__init__(level, schema_dict)
+    def __init__(self, level, schema_dict, context=None):
+        super(StringNode, self).__init__(level, schema_dict, context)
         self.allowed_values = schema_dict.pop('allowed_values', [])
         pattern = schema_dict.pop('allowed_pattern', None)
-        self.valid_pattern = re.compile(pattern) if pattern else None
+        if pattern:
+            import re
+            self.valid_pattern = re.compile(pattern)
+        else:
+            self.valid_pattern = None
 
     def realize_schema(self, attrs):
         super(StringNode, self).realize_schema(attrs)
@@ -283,22 +1510,19 @@ class StringNode(SchemaNode):
             tags['Allowed Pattern'] = self.valid_pattern
         return tags
 
-    def validate_data(self, data):
+    def validate_data(self, data, violations, path):
         # Check for valid values
         if self.allowed_values and data not in self.allowed_values:
             invalid_value = '%s is not a allowed value for %s. Expect it to be one of: %s'
-            return [ invalid_value % (data, self.level, ",".join(self.allowed_values)) ]
-
-        if self.valid_pattern and not self.valid_pattern.match(data):
-            return [ "%s does't match expression %s at %s" % (data, self.valid_pattern.pattern, self.level)]
-
-        return [ ]
+            violations.add(self, 'allowed_values', invalid_value % (data, self.level, ",".join(self.allowed_values)), path, data)
+        elif self.valid_pattern and not self.valid_pattern.match(data):
+            violations.add(self, 'pattern', "%s does't match expression %s at %s" % (data, self.valid_pattern.pattern, self.level), path, data)
 
 
 class SubSchemaNode(SchemaNode):
     subschema_denote = '.n'
-    def __init__(self, level, schema_dict):
-        super(SubSchemaNode, self).__init__(level, schema_dict)
+    def __init__(self, level, schema_dict, context=None):
+        super(SubSchemaNode, self).__init__(level, schema_dict, context)
         self._subschema_realized = False
         self._sub_schema = None
         self.sub_schema = schema_dict.pop('value_schema', None)
@@ -307,7 +1531,7 @@ class SubSchemaNode(SchemaNode):
         super(SubSchemaNode, self).realize_schema(attrs)
         if self.sub_schema:
             attrs['value_schema'] = { }
-            self.sub_schema.realize_schema(attrs['value_schema'])
+            self.sub_schema.realize_as_child(attrs['value_schema'])
 
     def get_sub_schema(self):
         return self._sub_schema
@@ -318,7 +1542,7 @@ class SubSchemaNode(SchemaNode):
                 raise SchemaError('Subschema already realized')
 
             try:
-                self.sub_schema = SchemaNode.create_schema_node(self._level+self.subschema_denote, obj)
+                self.sub_schema = SchemaNode.create_schema_node(self._level+self.subschema_denote, obj, self.context)
             except KeyError:
                 raise SchemaError('List type node requires a value_schema at %s' % self.level)
 
@@ -334,8 +1558,8 @@ class ListNode(SubSchemaNode):
     type = 'list'
     subschema_denote = "[i]"
 
-    def __init__(self, level, schema_dict):
-        super(ListNode, self).__init__(level, schema_dict)
+    def __init__(self, level, schema_dict, context=None):
+        super(ListNode, self).__init__(level, schema_dict, context)
         self.min_size = schema_dict.pop('minimum_size', None)
         self.max_size = schema_dict.pop('maximum_size', None)
 
@@ -377,18 +1601,50 @@ class ListNode(SubSchemaNode):
     def doc_child_list(self):
         return [ ('N/A', self.sub_schema) ] 
 
-    def validate_data(self, data):
-        schema_errors = []
+    def validate_data(self, data, violations, path):
+        if violations.sampling is not None:
+            for node, value, child_path in self.walk_data(data, violations, path):
+                node.check(value, violations, child_path)
+            return
+
+        self._check_size(data, violations, path)
+        sub_schema = self.sub_schema
+        if path is None:
+            for each_value in data:
+                sub_schema.check(each_value, violations)
+        else:
+            for i, each_value in enumerate(data):
+                sub_schema.check(each_value, violations, (path, i))
+        self._check_unique(data, violations, path)
+
+    def walk_data(self, data, violations, path):
+        self._check_size(data, violations, path)
+
+        sub_schema = self.sub_schema
+        sampling = violations.sampling
+        if sampling is not None:
+            values = data if isinstance(data, (list, tuple)) else _ordered_values(data)
+            for i in sampling.choose(self, len(values)):
+                mark = sampling.mark(violations)
+                yield sub_schema, values[i], None if path is None else (path, i)
+                sampling.observe(self, violations, mark)
+        elif path is None:
+            for each_value in data:
+                yield sub_schema, each_value, None
+        else:
+            for i, each_value in enumerate(data):
+                yield sub_schema, each_value, (path, i)
 
-        if self.min_size and len(data) < self.min_size:
-            schema_errors.append('Minimum size is set to %s, but actual size is %s at level %s' % (self.min_size, len(data), self.level))
+        self._check_unique(data, violations, path)
 
-        if self.max_size and len(data) < self.min_size:
-            schema_errors.append('Maximum size is set to %s, but actual size is %s at level %s' % (self.max_size, len(data), self.level))
+    def _check_size(self, data, violations, path):
+        if self.min_size and len(data) < self.min_size:
+            violations.add(self, 'minimum_size', 'Minimum size is set to %s, but actual size is %s at level %s' % (self.min_size, len(data), self.level), path, len(data))
 
-        for i, each_value in enumerate(data):
-            schema_errors.extend(self.sub_schema.validate(each_value))
+        if self.max_size and len(data) > self.max_size:
+            violations.add(self, 'maximum_size', 'Maximum size is set to %s, but actual size is %s at level %s' % (self.max_size, len(data), self.level), path, len(data))
 
+    def _check_unique(self, data, violations, path):
         if self.unique:
             dups = set()
             found = set()
@@ -398,9 +1654,7 @@ class ListNode(SubSchemaNode):
                 else:
                     found.add(x)
             if dups:
-                schema_errors.append('Duplicate(s) %s found for a unique list at %s' % ( ",".join(str(a) for a in dups), self.level))
-
-        return schema_errors
+                violations.add(self, 'unique', 'Duplicate(s) %s found for a unique list at %s' % ( ",".join(str(a) for a in dups), self.level), path)
 
 
 class NumberNode(SchemaNode):
@@ -409,8 +1663,8 @@ class NumberNode(SchemaNode):
     expected_types = integer_types
     type = 'number'
 
-    def __init__(self, level, schema_dict):
-        super(NumberNode, self).__init__(level, schema_dict)
+    def __init__(self, level, schema_dict, context=None):
+        super(NumberNode, self).__init__(level, schema_dict, context)
         self.min_value = schema_dict.pop('minimum_value', None)
         self.max_value = schema_dict.pop('maximum_value', None)
 
@@ -435,14 +1689,11 @@ class NumberNode(SchemaNode):
     def get_short_decoration(self):
         return "1"
 
-    def validate_data(self, data):
+    def validate_data(self, data, violations, path):
         if self.min_value and data < self.min_value:
-            return [ "Value %s is smaller than %s at %s" % (data, self.min_value, self.level)]
-
-        if self.max_value and data > self.max_value:
-            return [ "Value %s is greater than %s at %s" % (data, self.max_value, self.level)]
-
-        return [ ]
+            violations.add(self, 'minimum_value', "Value %s is smaller than %s at %s" % (data, self.min_value, self.level), path, data)
+        elif self.max_value and data > self.max_value:
+            violations.add(self, 'maximum_value', "Value %s is greater than %s at %s" % (data, self.max_value, self.level), path, data)
 
 
 class BooleanNode(SchemaNode):
@@ -451,8 +1702,8 @@ class BooleanNode(SchemaNode):
     expected_types = bool
     type = 'boolean'
 
-    def __init__(self, level, schema_dict):
-        super(BooleanNode, self).__init__(level, schema_dict)
+    def __init__(self, level, schema_dict, context=None):
+        super(BooleanNode, self).__init__(level, schema_dict, context)
         self.true_value = schema_dict.pop('true_value', 'True')
         self.false_value = schema_dict.pop('false_value', 'False')
 
@@ -470,14 +1721,16 @@ class BooleanNode(SchemaNode):
             'False Value': self.false_value
         }
 
-    def validate_data(self, data):
+    def validate_data(self, data, violations, path):
         """
         No additional validations necessary for boolean data
 
         :param data: data
+        :param violations: violation collector
+        :param path: path of the data
         :return:
         """
-        return [ ]
+        pass
 
 
 class MapNode(SubSchemaNode):
@@ -487,8 +1740,8 @@ class MapNode(SubSchemaNode):
     type = 'map'
     subschema_denote = ".<name>"
 
-    def __init__(self, level, schema_dict):
-        super(MapNode, self).__init__(level, schema_dict)
+    def __init__(self, level, schema_dict, context=None):
+        super(MapNode, self).__init__(level, schema_dict, context)
 
         # Create schema nodes for all known children and make sure there is default schema if
         # a name defines no specific schema
@@ -529,7 +1782,7 @@ class MapNode(SubSchemaNode):
         for k, v in iteritems(self.known_children):
             attrs['known_children'][k] = {}
             if v:
-                v.realize_schema(attrs['known_children'][k])
+                v.realize_as_child(attrs['known_children'][k])
 
         attrs['mandatory_children'] = list(self.mandatory_names)
 
@@ -546,41 +1799,82 @@ class MapNode(SubSchemaNode):
             if v:
                 yield k, v
 
-    def validate_data(self, data):
-        schema_errors = []
-        
-        def do_validate(data):
-            names_found = set()
-            # Go to the next level of validation
-            for each_key in data:
-    
-                if each_key not in self.known_children and self.allow_unknown_children == False:
-                    schema_errors.append('%s is not allowed at level %s' % (each_key, self.level))
-    
-                sub_schema = self.known_children.get(each_key) or self.sub_schema
-                if not sub_schema:
-                    schema_errors.append("No sub-schema found for %s at %s" % (each_key, self.level))
-                else:
-                    schema_errors.extend(sub_schema.validate(data[each_key]))
-    
-                names_found.add(each_key)
-    
-            remaining_names = self.mandatory_names - names_found
-            if remaining_names:
-                schema_errors.append("Values are required for %s at %s" % (",".join(remaining_names), self.level))
-        
-        if self.allow_list:
-            if isinstance(data, list):
-                level_save = self.level
-                for i,x in enumerate(data):
-                    self.level = level_save + str(i)
-                    do_validate(x)
-            else:
-                do_validate(data)
+    def validate_data(self, data, violations, path):
+        if violations.sampling is not None:
+            for node, value, child_path in self.walk_data(data, violations, path):
+                node.check(value, violations, child_path)
+        elif self.allow_list and isinstance(data, list):
+            for i, x in enumerate(data):
+                self._validate_map(x, violations, self.level + str(i), None if path is None else (path, i))
         else:
-            do_validate(data)
+            self._validate_map(data, violations, self.level, path)
+
+    def _validate_map(self, data, violations, level, path):
+        names_found = set()
+        # Go to the next level of validation
+        for each_key in data:
+            child_path = None if path is None else (path, each_key)
+            sub_schema = self._child_schema(each_key, violations, level, child_path)
+            if sub_schema:
+                sub_schema.check(data[each_key], violations, child_path)
+            names_found.add(each_key)
+
+        self._check_mandatory(names_found, violations, level, path)
+
+    def walk_data(self, data, violations, path):
+        if self.allow_list and isinstance(data, list):
+            for i, x in enumerate(data):
+                for child in self._walk_map(x, violations, self.level + str(i),
+                                            None if path is None else (path, i)):
+                    yield child
+        else:
+            for child in self._walk_map(data, violations, self.level, path):
+                yield child
+
+    def _walk_map(self, data, violations, level, path):
+        # Validate only a sample of the unknown children if there are too many of them, and
+        # count them in the estimates either way
+        sampling = violations.sampling
+        sampled_keys = None
+        if sampling is not None and self.allow_unknown_children:
+            unknown_keys = [x for x in data if x not in self.known_children]
+            sampled_keys = set(unknown_keys[i] for i in sampling.choose(self, len(unknown_keys)))
+
+        names_found = set()
+        for each_key in data:
+            names_found.add(each_key)
+            if sampled_keys is not None and each_key not in self.known_children:
+                if each_key in sampled_keys:
+                    mark = sampling.mark(violations)
+                    yield self.sub_schema, data[each_key], None if path is None else (path, each_key)
+                    sampling.observe(self, violations, mark)
+                continue
+
+            child_path = None if path is None else (path, each_key)
+            sub_schema = self._child_schema(each_key, violations, level, child_path)
+            if sub_schema:
+                yield sub_schema, data[each_key], child_path
+
+        self._check_mandatory(names_found, violations, level, path)
+
+    def _child_schema(self, each_key, violations, level, child_path):
+        """
+        Check that a child is allowed and get its schema
+
+        :return: Schema node for the child, or None if there is none
+        """
+        if each_key not in self.known_children and self.allow_unknown_children == False:
+            violations.add(self, 'unknown_child', '%s is not allowed at level %s' % (each_key, level), child_path, each_key)
+
+        sub_schema = self.known_children.get(each_key) or self.sub_schema
+        if not sub_schema:
+            violations.add(self, 'no_sub_schema', "No sub-schema found for %s at %s" % (each_key, level), child_path, each_key)
+        return sub_schema
 
-        return schema_errors
+    def _check_mandatory(self, names_found, violations, level, path):
+        remaining_names = self.mandatory_names - names_found
+        if remaining_names:
+            violations.add(self, 'mandatory', "Values are required for %s at %s" % (",".join(remaining_names), level), path)
 
     def set_known_children(self, child_object):
         if isinstance(child_object, dict):
@@ -590,7 +1884,7 @@ class MapNode(SubSchemaNode):
             self._known_children = {}
             for k,v in iteritems(child_object):
                 if v:
-                    self._known_children[k] = SchemaNode.create_schema_node(self._level+'.'+k, v)
+                    self._known_children[k] = SchemaNode.create_schema_node(self._level+'.'+k, v, self.context)
                 else:
                     self._known_children[k] = None
                     if self.sub_schema is None:
@@ -0,0 +1,32 @@
+from pyschema import Schema, CustomValidationPool
+from pprint import pprint
+from six import print_ as print_out
+from timeit import default_timer
+
+def checksum(a):
+    # About a tenth of a millisecond of work
+    return ["bad checksum"] if sum(range(a % 7 + 2000)) % 5 == 0 else [ ]
+
+s = Schema({
+    'type': 'list',
+    'display_name': 'Items',
+    'value_schema': {'type': 'number', 'display_name': 'Item', 'custom_validation': checksum}
+})
+
+items = list(range(10000))
+pool = CustomValidationPool(4, timeout=0.2)
+
+print_out("CUSTOM VALIDATIONS ON A POOL")
+print_out("----------------------------")
+inline = s.validate(items, aggregate=True)
+start = default_timer()
+pooled = s.validate(items, aggregate=True, custom_pool=pool)
+elapsed = default_timer() - start
+# The backlog takes much longer than the timeout, but each call is within it
+assert elapsed > pool.timeout, elapsed
+assert pooled == inline, (inline, pooled)
+assert pool.timing_report()['checksum']['timeouts'] == 0, pool.timing_report()
+print_out("Same violations with and without the pool, no timeouts:")
+pprint(pooled)
+
+pool.shutdown()
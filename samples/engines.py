@@ -0,0 +1,60 @@
+from pyschema import Schema, CustomValidationPool
+from pprint import pprint
+from six import print_ as print_out
+
+def even_only(a):
+    return ["size must be even"] if len(a) % 2 else [ ]
+
+s = Schema({
+    'display_name': 'Engines',
+    'known_children': {
+        'names': {
+            'type': 'list',
+            'display_name': 'Names',
+            'unique': True,
+            'minimum_size': 2,
+            'custom_validation': even_only,
+            'value_schema': {
+                'type': 'string',
+                'display_name': 'Name',
+                'allowed_values': ['ab', 'cd', 'e'],
+                'custom_validation': even_only
+            }
+        },
+        'records': {
+            'display_name': 'Records',
+            'allow_list': True,
+            'mandatory_children': ['id'],
+            'known_children': {
+                'id': {'type': 'number', 'display_name': 'Id', 'minimum_value': 1}
+            },
+            'allow_unknown_children': True,
+            'value_schema': {'type': 'boolean', 'display_name': 'Flag', 'allow_none': True}
+        }
+    },
+    'mandatory_children': ['names']
+})
+
+documents = [
+    {'names': ['ab', 'e', 'ab', 'xyz'], 'records': [{'id': 0, 'on': True}, {'off': None}, {'id': 'x', 'f': 1}]},
+    {'names': ['e'], 'records': {'id': 5, 'on': 'yes'}},
+    {'records': [{'id': 2}], 'other': 1},
+    {'names': 'ab'},
+    []
+]
+
+pool = CustomValidationPool(2)
+
+print_out("RECURSIVE AND ITERATIVE ENGINES")
+print_out("-------------------------------")
+for doc in documents:
+    for aggregate in (False, True):
+        recursive = s.validate(doc, aggregate=aggregate)
+        iterative = s.validate(doc, aggregate=aggregate, engine='iterative')
+        assert recursive == iterative, (doc, recursive, iterative)
+        # Custom validations on a pool are merged back in the same order
+        pooled = s.validate(doc, aggregate=aggregate, custom_pool=pool)
+        assert recursive == pooled, (doc, recursive, pooled)
+    print_out("Same violations from both engines:")
+    pprint(s.validate(doc))
+pool.shutdown()